@@ -7,6 +7,7 @@ from .normalization import (
     ens_normalizations,
     is_ens_normalized,
     is_ens_normalizable,
+    ens_cache_clear,
     DisallowedSequence,
     DisallowedSequenceType,
     CurableSequence,
@@ -1,15 +1,44 @@
 from typing import Callable, Dict, List, NamedTuple, Set, Optional, Tuple, Union, Iterable
 from enum import Enum
+from array import array
+from functools import lru_cache, partial
 import re
 import json
 import os
 import pickle
-from pyunormalize import NFC, NFD, UNICODE_VERSION
+import gc
+import unicodedata
+import pyunormalize
+from pyunormalize import UNICODE_VERSION
 import warnings
 
+try:
+    # optional, provides newer Unicode versions than the standard library
+    import unicodedata2
+except ImportError:
+    unicodedata2 = None
+
 
 SPEC_PICKLE_PATH = os.path.join(os.path.dirname(__file__), 'spec.pickle')
 
+# prefer C implementations of the Unicode version that pyunormalize implements
+if unicodedata2 is not None and unicodedata2.unidata_version == UNICODE_VERSION:
+    NFC = partial(unicodedata2.normalize, 'NFC')
+    NFD = partial(unicodedata2.normalize, 'NFD')
+elif unicodedata.unidata_version == UNICODE_VERSION:
+    NFC = partial(unicodedata.normalize, 'NFC')
+    NFD = partial(unicodedata.normalize, 'NFD')
+else:
+    NFC = pyunormalize.NFC
+    NFD = pyunormalize.NFD
+
+# number of recent results kept by the cached public functions
+RESULT_CACHE_SIZE = 65536
+# number of recent NFC results kept for short sequences
+NFC_CACHE_SIZE = 4096
+# longest sequence stored in the NFC cache
+NFC_CACHE_MAX_LEN = 32
+
 
 class DisallowedSequenceTypeBase(Enum):
     """
@@ -260,6 +289,32 @@ CP_SLASH = 8260
 CP_MIDDLE_DOT = 12539
 CP_XI_SMALL = 0x3BE
 CP_XI_CAPITAL = 0x39E
+XI_TO_CAPITAL = str.maketrans({CP_XI_SMALL: CP_XI_CAPITAL})
+
+
+# token classes stored in NormalizationData.cp_class
+CLS_DISALLOWED = 0
+CLS_VALID = 1
+CLS_IGNORED = 2
+CLS_MAPPED = 3
+CLS_STOP = 4
+
+# codepoint property flags stored in NormalizationData.cp_props
+PROP_NFC_CHECK = 1
+PROP_FENCED = 2
+PROP_CM = 4
+PROP_NSM = 8
+PROP_NFD_NSM = 16
+PROP_WHOLE = 32
+
+# key marking the end of an emoji in NormalizationData.emoji_trie
+EMOJI_TRIE_END = -1
+
+# NormalizationData attributes holding codepoint tables
+CP_TABLES = ('cp_class', 'cp_props', 'cp_groups')
+
+# size of the blocks used to store codepoint tables in the pickle
+CP_TABLE_BLOCK = 256
 
 
 class TokenValid(NamedTuple):
@@ -311,6 +366,9 @@ Token = Union[
     TokenNFC,
 ]
 
+# stop tokens carry no per-input data, so a single instance is shared
+TOKEN_STOP = TokenStop()
+
 
 class ENSProcessResult(NamedTuple):
     normalized: Optional[str]
@@ -326,45 +384,87 @@ def str2cps(text: str) -> List[int]:
     """
     Convert text to a list of integer codepoints.
     """
-    return [ord(c) for c in text]
+    return list(map(ord, text))
 
 
 def cps2str(cps: List[int]) -> str:
     """
     Convert a list of integer codepoints to string.
     """
-    return ''.join(chr(cp) for cp in cps)
+    return ''.join(map(chr, cps))
 
 
-def filter_fe0f(text: str) -> str:
+def create_emoji_trie(emojis: List[List[int]]) -> Dict:
     """
-    Remove all FE0F from text.
+    Create a trie of emoji codepoint sequences.
+    Every FE0F in an emoji is optional so each emoji is inserted with all of its FE0F variants.
+    Nodes are dicts mapping a codepoint to the child node,
+    a node where an emoji ends also maps `EMOJI_TRIE_END` to the index of that emoji.
     """
-    return text.replace('\ufe0f', '')
-
-
-def create_emoji_regex_pattern(emojis: List[str]) -> str:
-    fe0f = re.escape('\ufe0f')
-
-    def make_emoji(emoji: str) -> str:
-        # make FE0F optional
-        return re.escape(emoji).replace(fe0f, f'{fe0f}?')
+    root = {}
+    for emoji_id, emoji in enumerate(emojis):
+        # nodes reached by all variants of the emoji prefix
+        nodes = [root]
+        for cp in emoji:
+            children = [node.setdefault(cp, {}) for node in nodes]
+            if cp == CP_FE0F:
+                # FE0F can be skipped
+                children.extend(nodes)
+            nodes = children
+        for node in nodes:
+            node[EMOJI_TRIE_END] = emoji_id
+    return root
+
+
+def create_valid_run_pattern(valid: Set[int], nfc_check: Set[int], emoji_trie: Dict) -> str:
+    """
+    Create a regex pattern matching runs of valid codepoints that can be tokenized in bulk.
+    Codepoints that need an NFC check are excluded.
+    Codepoints that start an emoji are excluded unless the emoji can only continue
+    with codepoints outside of the run, so at most the last codepoint of a run can start an emoji.
+    """
+    run_cps = valid - nfc_check
+    run_cps = set(
+        cp
+        for cp in run_cps
+        if cp not in emoji_trie
+        or all(next_cp != EMOJI_TRIE_END and next_cp not in run_cps for next_cp in emoji_trie[cp])
+    )
+    return create_cp_set_pattern(run_cps) + '+'
 
-    # sort to match the longest first
-    def order(emoji: str) -> int:
-        # emojis with FE0F need to be pushed back because the FE0F would trap the regex matching
-        # re.search(r'AF?|AB', '_AB_')
-        # >>> <re.Match object; span=(1, 2), match='A'>
-        return len(filter_fe0f(emoji))
 
-    return '|'.join(make_emoji(emoji) for emoji in sorted(emojis, key=order, reverse=True))
+def create_cp_set_pattern(cps: Iterable[int]) -> str:
+    """
+    Create a regex character set matching any of the codepoints.
+    """
+    ranges = []
+    for cp in sorted(cps):
+        if ranges and ranges[-1][1] == cp - 1:
+            ranges[-1][1] = cp
+        else:
+            ranges.append([cp, cp])
+    return (
+        '['
+        + ''.join(re.escape(chr(a)) if a == b else f'{re.escape(chr(a))}-{re.escape(chr(b))}' for a, b in ranges)
+        + ']'
+    )
 
 
-def create_emoji_fe0f_lookup(emojis: List[str]) -> Dict[str, str]:
+def match_emoji(input: str, start: int) -> Optional[Tuple[int, int]]:
     """
-    Create a lookup table for recreating FE0F emojis from non-FE0F emojis.
+    Find the longest emoji starting at `start` in the input.
+    Returns the end of the match and the index of the emoji in `NORMALIZATION.emoji`.
     """
-    return {filter_fe0f(emoji): emoji for emoji in emojis}
+    node = NORMALIZATION.emoji_trie
+    match = None
+    for i in range(start, len(input)):
+        node = node.get(ord(input[i]))
+        if node is None:
+            break
+        emoji_id = node.get(EMOJI_TRIE_END)
+        if emoji_id is not None:
+            match = i + 1, emoji_id
+    return match
 
 
 def compute_valid(groups: List[Dict]) -> Set[int]:
@@ -394,6 +494,38 @@ def read_groups(groups: List[Dict]) -> List[Dict]:
     ]
 
 
+def create_group_masks(groups: List[Dict]) -> Tuple[bytes, List[int]]:
+    """
+    Create a table indexed by codepoint that holds an index into a list of group bitmasks.
+    Bit `i` of a bitmask is set if the codepoint is valid in `groups[i]`.
+    There are only a few distinct bitmasks so they are stored once in the list.
+    """
+    cp_masks = {}
+    for i, g in enumerate(groups):
+        for cp in g['V']:
+            cp_masks[cp] = cp_masks.get(cp, 0) | (1 << i)
+    # index 0 is for codepoints that are not in any group
+    masks = [0] + sorted(set(cp_masks.values()))
+    assert len(masks) <= 256
+    mask_ids = {mask: i for i, mask in enumerate(masks)}
+    table = bytearray(0x110000)
+    for cp, mask in cp_masks.items():
+        table[cp] = mask_ids[mask]
+    return bytes(table), masks
+
+
+def groups_from_mask(mask: int) -> List[Dict]:
+    """
+    Get the groups selected by a group bitmask (see `create_group_masks`).
+    """
+    groups = []
+    while mask:
+        low = mask & -mask
+        groups.append(NORMALIZATION.groups[low.bit_length() - 1])
+        mask ^= low
+    return groups
+
+
 def try_str_to_int(x):
     try:
         return int(x)
@@ -410,26 +542,78 @@ def dict_keys_to_int(d):
     return d
 
 
-def find_group_id(groups, name):
-    """
-    Find the index of a group by name.
-    """
-    for i, g in enumerate(groups):
-        if g['name'] == name:
-            return i
-
-
 def group_names_to_ids(groups, whole_map):
     """
     Convert group names to group ids in the whole_map for faster lookup.
+    Also stores the ids as a bitmask in `M_bits`.
     """
+    name_to_id = {g['name']: i for i, g in enumerate(groups)}
     for v in whole_map.values():
         if isinstance(v, dict):
+            v['M_bits'] = {}
             for k in v['M']:
                 for i in range(len(v['M'][k])):
-                    id = find_group_id(groups, v['M'][k][i])
-                    assert id is not None
-                    v['M'][k][i] = id
+                    v['M'][k][i] = name_to_id[v['M'][k][i]]
+                v['M_bits'][k] = sum(1 << id for id in v['M'][k])
+
+
+def compute_nfd_nsm(valid: Set[int], nsm: Set[int]) -> Set[int]:
+    """
+    Find valid codepoints whose NFD contains an NSM.
+    Labels without such codepoints do not need to be decomposed for the NSM checks.
+    """
+    return {cp for cp in valid if any(ord(c) in nsm for c in NFD(chr(cp)))}
+
+
+def create_cp_class_table(valid: Set[int], ignored: Set[int], mapped: Dict[int, List[int]]) -> bytes:
+    """
+    Create a table indexed by codepoint that holds the token class (`CLS_*`) of every codepoint.
+    """
+    table = bytearray(0x110000)
+    for cp in mapped:
+        table[cp] = CLS_MAPPED
+    for cp in ignored:
+        table[cp] = CLS_IGNORED
+    for cp in valid:
+        table[cp] = CLS_VALID
+    table[CP_STOP] = CLS_STOP
+    return bytes(table)
+
+
+def create_cp_props_table(props: Dict[int, Iterable[int]]) -> bytes:
+    """
+    Create a table indexed by codepoint that holds the property flags (`PROP_*`) of every codepoint.
+    """
+    table = bytearray(0x110000)
+    for flag, cps in props.items():
+        for cp in cps:
+            table[cp] |= flag
+    return bytes(table)
+
+
+def pack_cp_table(table: bytes) -> Tuple[array, List[bytes]]:
+    """
+    Split a codepoint table into a two-stage table of deduplicated blocks.
+    Most blocks repeat (e.g. unassigned planes) so this is much smaller than the full table.
+    """
+    block_ids = {}
+    blocks = []
+    stage1 = array('H')
+    for i in range(0, len(table), CP_TABLE_BLOCK):
+        block = table[i : i + CP_TABLE_BLOCK]
+        block_id = block_ids.get(block)
+        if block_id is None:
+            block_id = block_ids[block] = len(blocks)
+            blocks.append(block)
+        stage1.append(block_id)
+    return stage1, blocks
+
+
+def unpack_cp_table(stage1: array, blocks: List[bytes]) -> bytes:
+    """
+    Expand a two-stage table created by `pack_cp_table` back into a flat table.
+    """
+    return b''.join([blocks[block_id] for block_id in stage1])
 
 
 class NormalizationData:
@@ -446,6 +630,7 @@ class NormalizationData:
         self.fenced: Dict[int, str] = {x[0]: x[1] for x in spec['fenced']}
         self.groups: List[Dict] = read_groups(spec['groups'])
         self.valid: Set[int] = compute_valid(self.groups)
+        self.cp_groups, self.group_masks = create_group_masks(self.groups)
         self.whole_map: Dict = dict_keys_to_int(spec['whole_map'])
         group_names_to_ids(self.groups, self.whole_map)
         self.nsm_max: int = spec['nsm_max']
@@ -453,18 +638,54 @@ class NormalizationData:
 
         self.cm.remove(CP_FE0F)
 
-        self.emoji_fe0f_lookup = create_emoji_fe0f_lookup([''.join(chr(cp) for cp in cps) for cps in self.emoji])
-        self.emoji_regex = re.compile(
-            create_emoji_regex_pattern([''.join(chr(cp) for cp in cps) for cps in self.emoji])
+        # text version of each emoji
+        self.emoji_no_fe0f: List[List[int]] = [[cp for cp in emoji if cp != CP_FE0F] for emoji in self.emoji]
+        self.emoji_trie: Dict = create_emoji_trie(self.emoji)
+        self.valid_run_regex = re.compile(create_valid_run_pattern(self.valid, self.nfc_check, self.emoji_trie))
+        # normalized names consist only of these codepoints
+        self.normalized_cps_regex = re.compile(create_cp_set_pattern(self.valid.union([CP_STOP], *self.emoji)) + '*')
+
+        # one byte per codepoint, replaces the valid/ignored/mapped lookups in the tokenizer
+        self.cp_class: bytes = create_cp_class_table(self.valid, self.ignored, self.mapped)
+        # one byte of flags per codepoint, replaces set lookups in hot loops
+        self.cp_props: bytes = create_cp_props_table(
+            {
+                PROP_NFC_CHECK: self.nfc_check,
+                PROP_FENCED: self.fenced,
+                PROP_CM: self.cm,
+                PROP_NSM: self.nsm,
+                PROP_NFD_NSM: compute_nfd_nsm(self.valid, self.nsm),
+                PROP_WHOLE: self.whole_map.keys(),
+            }
         )
 
+    def __getstate__(self):
+        # store the codepoint tables compactly, they are expanded in __setstate__
+        state = self.__dict__.copy()
+        for name in CP_TABLES:
+            state[name] = pack_cp_table(state[name])
+        return state
+
+    def __setstate__(self, state):
+        for name in CP_TABLES:
+            state[name] = unpack_cp_table(*state[name])
+        self.__dict__.update(state)
+
 
 def load_normalization_data_pickle(spec_pickle_path: str) -> NormalizationData:
     """
     Loads `NormalizationData` from a pickle file.
     """
-    with open(spec_pickle_path, 'rb') as f:
-        return pickle.load(f)
+    # the data holds many containers but no reference cycles,
+    # collecting while they are created only slows down loading
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        with open(spec_pickle_path, 'rb') as f:
+            return pickle.load(f)
+    finally:
+        if gc_enabled:
+            gc.enable()
 
 
 NORMALIZATION = load_normalization_data_pickle(SPEC_PICKLE_PATH)
@@ -488,26 +709,47 @@ def collapse_valid_tokens(tokens: List[Token]) -> List[Token]:
     Combine cps from continuous valid tokens into single tokens.
     """
     out = []
-    i = 0
-    while i < len(tokens):
-        if tokens[i].type == TY_VALID:
-            j = i + 1
-            while j < len(tokens) and tokens[j].type == TY_VALID:
-                j += 1
-            out.append(
-                TokenValid(
-                    cps=[cp for k in range(i, j) for cp in tokens[k].cps],
+    # cps of the last output token if it is valid
+    valid_cps = None
+    for tok in tokens:
+        if tok.type == TY_VALID:
+            if valid_cps is None:
+                valid_cps = list(tok.cps)
+                out.append(
+                    TokenValid(
+                        cps=valid_cps,
+                    )
                 )
-            )
-            i = j
+            else:
+                valid_cps.extend(tok.cps)
         else:
-            out.append(tokens[i])
-            i += 1
+            valid_cps = None
+            out.append(tok)
     return out
 
 
+@lru_cache(maxsize=NFC_CACHE_SIZE)
+def nfc_cached(text: str) -> str:
+    """
+    NFC with a cache, used for the short sequences that `normalize_tokens` checks.
+    """
+    return NFC(text)
+
+
 def cps_requires_check(cps: List[int]) -> bool:
-    return any(cp in NORMALIZATION.nfc_check for cp in cps)
+    cp_props = NORMALIZATION.cp_props
+    return any(cp_props[cp] & PROP_NFC_CHECK for cp in cps)
+
+
+def token_requires_check(token: Token) -> bool:
+    """
+    Check if a valid or mapped token needs an NFC check.
+    The tokenizer emits codepoints that need a check as single codepoint valid tokens,
+    so longer valid tokens do not have to be scanned.
+    """
+    if token.type == TY_VALID:
+        return len(token.cps) == 1 and NORMALIZATION.cp_props[token.cps[0]] & PROP_NFC_CHECK != 0
+    return cps_requires_check(token.cps)
 
 
 def normalize_tokens(tokens: List[Token]) -> List[Token]:
@@ -516,14 +758,23 @@ def normalize_tokens(tokens: List[Token]) -> List[Token]:
     """
     i = 0
     start = -1
+    checked = False
     while i < len(tokens):
         token = tokens[i]
         if token.type in (TY_VALID, TY_MAPPED):
-            if cps_requires_check(token.cps):
+            if token_requires_check(token):
+                checked = True
+                if start >= 0 and tokens[start].type == TY_VALID and len(tokens[start].cps) > 1:
+                    # the tokenizer emits runs of valid codepoints,
+                    # only the last codepoint of the run takes part in NFC
+                    run = tokens[start].cps
+                    tokens[start : start + 1] = [TokenValid(cps=run[:-1]), TokenValid(cps=run[-1:])]
+                    start += 1
+                    i += 1
                 end = i + 1
                 for pos in range(end, len(tokens)):
                     if tokens[pos].type in (TY_VALID, TY_MAPPED):
-                        if not cps_requires_check(tokens[pos].cps):
+                        if not token_requires_check(tokens[pos]):
                             break
                         end = pos + 1
                     elif tokens[pos].type != TY_IGNORED:
@@ -533,7 +784,7 @@ def normalize_tokens(tokens: List[Token]) -> List[Token]:
                 slice = tokens[start:end]
                 cps = [cp for tok in slice if tok.type in (TY_VALID, TY_MAPPED) for cp in tok.cps]
                 str0 = cps2str(cps)
-                str = NFC(str0)
+                str = nfc_cached(str0) if len(str0) <= NFC_CACHE_MAX_LEN else NFC(str0)
                 if str0 == str:
                     i = end - 1
                 else:
@@ -550,7 +801,9 @@ def normalize_tokens(tokens: List[Token]) -> List[Token]:
         elif token.type != TY_IGNORED:
             start = -1
         i += 1
-    return collapse_valid_tokens(tokens)
+    # the tokenizer already merges valid tokens,
+    # only tokens that needed an NFC check can be left apart
+    return collapse_valid_tokens(tokens) if checked else tokens
 
 
 def post_check_empty(name: str, input: str) -> Optional[CurableSequence]:
@@ -587,24 +840,20 @@ def post_check_empty(name: str, input: str) -> Optional[CurableSequence]:
 
 
 def post_check_underscore(label: str) -> Optional[CurableSequence]:
-    in_middle = False
-    for i, c in enumerate(label):
-        if c != '_':
-            in_middle = True
-        elif in_middle:
-            cnt = 1
-            while i + cnt < len(label) and label[i + cnt] == '_':
-                cnt += 1
-            return CurableSequence(
-                CurableSequenceType.UNDERSCORE,
-                index=i,
-                sequence='_' * cnt,
-                suggested='',
-            )
+    # leading underscores are allowed
+    i = label.find('_', len(label) - len(label.lstrip('_')))
+    if i >= 0:
+        cnt = len(label) - i - len(label[i:].lstrip('_'))
+        return CurableSequence(
+            CurableSequenceType.UNDERSCORE,
+            index=i,
+            sequence='_' * cnt,
+            suggested='',
+        )
 
 
 def post_check_hyphen(label: str) -> Optional[CurableSequence]:
-    if len(label) >= 4 and all(ord(cp) < 0x80 for cp in label) and '-' == label[2] == label[3]:
+    if len(label) >= 4 and '-' == label[2] == label[3] and label.isascii():
         return CurableSequence(
             CurableSequenceType.HYPHEN,
             index=2,
@@ -614,8 +863,9 @@ def post_check_hyphen(label: str) -> Optional[CurableSequence]:
 
 
 def post_check_cm_leading_emoji(cps: List[int]) -> Optional[CurableSequence]:
+    cp_props = NORMALIZATION.cp_props
     for i in range(len(cps)):
-        if cps[i] in NORMALIZATION.cm:
+        if cp_props[cps[i]] & PROP_CM:
             if i == 0:
                 return CurableSequence(
                     CurableSequenceType.CM_START,
@@ -654,17 +904,14 @@ def make_fenced_error(cps: List[int], start: int, end: int) -> CurableSequence:
 
 
 def post_check_fenced(cps: List[int]) -> Optional[CurableSequence]:
-    cp = cps[0]
-    prev = NORMALIZATION.fenced.get(cp)
-    if prev is not None:
+    cp_props = NORMALIZATION.cp_props
+    if cp_props[cps[0]] & PROP_FENCED:
         return make_fenced_error(cps, 0, 1)
 
     n = len(cps)
     last = -1
     for i in range(1, n):
-        cp = cps[i]
-        match = NORMALIZATION.fenced.get(cp)
-        if match is not None:
+        if cp_props[cps[i]] & PROP_FENCED:
             if last == i:
                 return make_fenced_error(cps, i - 1, i + 1)
             last = i + 1
@@ -674,25 +921,31 @@ def post_check_fenced(cps: List[int]) -> Optional[CurableSequence]:
 
 
 def post_check_group_whole(
-    cps: List[int], is_greek: List[bool]
-) -> Optional[Union[DisallowedSequence, CurableSequence]]:
-    cps_no_fe0f = [cp for cp in cps if cp != CP_FE0F]
+    cps: List[int], check_whole: bool = True
+) -> Tuple[Optional[Union[DisallowedSequence, CurableSequence]], bool]:
+    """
+    Check the label against its group and whole-script confusables.
+    Returns the error and whether the label is Greek.
+    """
+    # reuse the label codepoints unless there is an FE0F to drop
+    cps_no_fe0f = [cp for cp in cps if cp != CP_FE0F] if CP_FE0F in cps else cps
     unique = set(cps_no_fe0f)
     # we pass cps with fe0f to align error position with the original input
     g, e = determine_group(unique, cps)
     if e is not None:
-        return e
+        return e, False
     g = g[0]
-    # pass is_greek up to the caller
-    is_greek[0] = g['name'] == 'Greek'
-    return post_check_group(g, cps_no_fe0f, cps) or post_check_whole(g, unique)
+    e = post_check_group(g, cps_no_fe0f, cps)
+    if e is None and check_whole:
+        e = post_check_whole(g, unique)
+    return e, g['name'] == 'Greek'
 
 
 def meta_for_conf_mixed(g, cp):
     """
     Create metadata for the CONF_MIXED error.
     """
-    s1 = [g['name'] for g in NORMALIZATION.groups if cp in g['V']]
+    s1 = [g['name'] for g in groups_from_mask(NORMALIZATION.group_masks[NORMALIZATION.cp_groups[cp]])]
     s1 = s1[0] if s1 else None
     s2 = g['name']
     if s1 is not None:
@@ -710,11 +963,15 @@ def meta_for_conf_mixed(g, cp):
 
 
 def determine_group(unique: Iterable[int], cps: List[int]) -> Tuple[Optional[List[Dict]], Optional[CurableSequence]]:
-    groups = NORMALIZATION.groups
+    cp_groups = NORMALIZATION.cp_groups
+    group_masks = NORMALIZATION.group_masks
+    # bitmask of the groups that contain all codepoints seen so far
+    all_groups = (1 << len(NORMALIZATION.groups)) - 1
+    groups = all_groups
     for cp in unique:
-        gs = [g for g in groups if cp in g['V']]
-        if len(gs) == 0:
-            if groups == NORMALIZATION.groups:
+        gs = groups & group_masks[cp_groups[cp]]
+        if gs == 0:
+            if groups == all_groups:
                 return None, CurableSequence(
                     CurableSequenceType.DISALLOWED,
                     index=cps.index(cp),
@@ -727,12 +984,15 @@ def determine_group(unique: Iterable[int], cps: List[int]) -> Tuple[Optional[Lis
                     index=cps.index(cp),
                     sequence=chr(cp),
                     suggested='',
-                    meta=meta_for_conf_mixed(groups[0], cp),
+                    meta=meta_for_conf_mixed(groups_from_mask(groups)[0], cp),
                 )
         groups = gs
-        if len(groups) == 1:
+        # stop when a single group is left
+        if groups & (groups - 1) == 0:
             break
-    return groups, None
+    if groups == all_groups:
+        return NORMALIZATION.groups, None
+    return groups_from_mask(groups), None
 
 
 def post_check_group(g, cps: List[int], input: List[int]) -> Optional[Union[DisallowedSequence, CurableSequence]]:
@@ -746,14 +1006,16 @@ def post_check_group(g, cps: List[int], input: List[int]) -> Optional[Union[Disa
                 suggested='',
                 meta=meta_for_conf_mixed(g, cp),
             )
-    if m:
+    cp_props = NORMALIZATION.cp_props
+    # skip decomposition if it cannot produce NSMs
+    if m and any(cp_props[cp] & PROP_NFD_NSM for cp in cps):
         decomposed = str2cps(NFD(cps2str(cps)))
         i = 1
         e = len(decomposed)
         while i < e:
-            if decomposed[i] in NORMALIZATION.nsm:
+            if cp_props[decomposed[i]] & PROP_NSM:
                 j = i + 1
-                while j < e and decomposed[j] in NORMALIZATION.nsm:
+                while j < e and cp_props[decomposed[j]] & PROP_NSM:
                     if j - i + 1 > NORMALIZATION.nsm_max:
                         return DisallowedSequence(DisallowedSequenceType.NSM_TOO_MANY)
                     for k in range(i, j):
@@ -766,24 +1028,30 @@ def post_check_group(g, cps: List[int], input: List[int]) -> Optional[Union[Disa
 
 def post_check_whole(group, cps: Iterable[int]) -> Optional[DisallowedSequence]:
     # Cannot report error index, operating on unique codepoints.
+    # group ids in the order of the first confusable
     maker = None
+    # bitmask of the group ids shared by all confusables
+    maker_bits = 0
     shared = []
+    whole_map = NORMALIZATION.whole_map
     for cp in cps:
-        whole = NORMALIZATION.whole_map.get(cp)
+        whole = whole_map.get(cp)
         if whole == 1:
             return None
         if whole is not None:
-            set_ = whole['M'].get(cp)
             if maker is not None:
-                maker = [g for g in maker if g in set_]
+                maker_bits &= whole['M_bits'][cp]
             else:
-                maker = list(set_)
-            if len(maker) == 0:
+                maker = whole['M'][cp]
+                maker_bits = whole['M_bits'][cp]
+            if maker_bits == 0:
                 return None
         else:
             shared.append(cp)
     if maker is not None:
         for g_ind in maker:
+            if not maker_bits >> g_ind & 1:
+                continue
             g = NORMALIZATION.groups[g_ind]
             if all(cp in g['V'] for cp in shared):
                 return DisallowedSequence(
@@ -804,20 +1072,29 @@ def post_check(
     e = post_check_empty(name, input)
     if e is not None:
         return e
+    cp_props = NORMALIZATION.cp_props
     label_offset = 0
     for label in name.split('.'):
-        # will be set inside post_check_group_whole
-        is_greek = [False]
-        cps = str2cps(label)
-        e = (
-            post_check_underscore(label)
-            or post_check_hyphen(label)
-            or post_check_cm_leading_emoji(cps)
-            or post_check_fenced(cps)
-            or post_check_group_whole(cps, is_greek)
-        )
+        # inlined str2cps
+        cps = list(map(ord, label))
+        # collect the flags of the label in one pass to skip checks that cannot fail
+        props = 0
+        for cp in cps:
+            props |= cp_props[cp]
+        e = post_check_underscore(label)
+        if e is None:
+            e = post_check_hyphen(label)
+        if e is None and props & PROP_CM:
+            e = post_check_cm_leading_emoji(cps)
+        if e is None and props & PROP_FENCED:
+            e = post_check_fenced(cps)
+        if e is not None:
+            is_greek = False
+        else:
+            # whole-script confusables need at least one codepoint from whole_map
+            e, is_greek = post_check_group_whole(cps, bool(props & PROP_WHOLE))
         # was this label greek?
-        label_is_greek.append(is_greek[0])
+        label_is_greek.append(is_greek)
         if e is not None:
             # post_checks are called on a single label and need an offset
             if isinstance(e, CurableSequence):  # or NormalizableSequence because of inheritance
@@ -877,40 +1154,41 @@ def tokens2str(tokens: List[Token], emoji_fn: Callable[[TokenEmoji], str] = lamb
         elif tok.type == TY_STOP:
             t.append(chr(tok.cp))
         else:
-            t.append(cps2str(tok.cps))
+            # inlined cps2str
+            t.append(''.join(map(chr, tok.cps)))
     return ''.join(t)
 
 
 def tokens2beautified(tokens: List[Token], label_is_greek: List[bool]) -> str:
     s = []
     label_index = 0
-    label_start = 0
-    for i in range(len(tokens) + 1):
-        if i < len(tokens) and tokens[i].type != TY_STOP:
+    for tok in tokens:
+        if tok.type in (TY_IGNORED, TY_DISALLOWED):
             continue
-        label_end = i
-
-        for j in range(label_start, label_end):
-            tok = tokens[j]
-            if tok.type in (TY_IGNORED, TY_DISALLOWED):
-                continue
-            elif tok.type == TY_EMOJI:
-                s.append(cps2str(tok.emoji))
-            elif tok.type == TY_STOP:
-                s.append(chr(tok.cp))
-            else:
-                if not label_is_greek[label_index]:
-                    s.append(cps2str([CP_XI_CAPITAL if cp == CP_XI_SMALL else cp for cp in tok.cps]))
-                else:
-                    s.append(cps2str(tok.cps))
+        elif tok.type == TY_EMOJI:
+            s.append(cps2str(tok.emoji))
+        elif tok.type == TY_STOP:
+            s.append(chr(tok.cp))
+            label_index += 1
+        elif label_is_greek[label_index]:
+            s.append(cps2str(tok.cps))
+        else:
+            s.append(cps2str(tok.cps).translate(XI_TO_CAPITAL))
+    return ''.join(s)
 
-        label_start = i
-        label_index += 1
 
-    return ''.join(s)
+SIMPLE_NAME_REGEX = re.compile(r'[a-z0-9]+(?:\.[a-z0-9]+)*')
+# lowercase ASCII names that can only fail the underscore and hyphen checks
+ASCII_NAME_REGEX = re.compile(r'[a-z0-9_-]+(?:\.[a-z0-9_-]+)*')
 
 
-SIMPLE_NAME_REGEX = re.compile(r'^[a-z0-9]+(?:\.[a-z0-9]+)*$')
+def ascii_name_post_check(name: str) -> bool:
+    """
+    Check if a name matching `ASCII_NAME_REGEX` passes all post checks.
+    """
+    if '_' not in name and '-' not in name:
+        return True
+    return not any(post_check_underscore(label) or post_check_hyphen(label) for label in name.split('.'))
 
 
 def ens_process(
@@ -941,14 +1219,14 @@ def ens_process(
     - `error`: `DisallowedSequence` or `CurableSequence` or `None` if input is valid
     - `normalizations`: list of `NormalizableSequence` objects or `None` if `do_normalizations` is `False`
     """
-    if SIMPLE_NAME_REGEX.match(input) is not None:
+    if SIMPLE_NAME_REGEX.fullmatch(input) is not None:
         if do_tokenize:
             tokens = []
             current_cps = []
             for c in input:
                 if ord(c) == CP_STOP:
                     tokens.append(TokenValid(cps=current_cps))
-                    tokens.append(TokenStop())
+                    tokens.append(TOKEN_STOP)
                     current_cps = []
                 else:
                     current_cps.append(ord(c))
@@ -965,93 +1243,166 @@ def ens_process(
             normalizations=[] if do_normalizations else None,
         )
 
+    if not do_tokenize and not do_normalizations and input.isascii():
+        # ASCII uppercase letters are mapped to lowercase,
+        # only tokens and normalizations would report the mappings
+        lowered = input.lower()
+        if ASCII_NAME_REGEX.fullmatch(lowered) is not None and ascii_name_post_check(lowered):
+            return ENSProcessResult(
+                normalized=lowered if do_normalize else None,
+                beautified=lowered if do_beautify else None,
+                tokens=None,
+                cured=lowered if do_cure else None,
+                cures=[] if do_cure else None,
+                error=None,
+                normalizations=None,
+            )
+
     tokens: List[Token] = []
     error = None
 
+    cp_class = NORMALIZATION.cp_class
+    emoji_trie = NORMALIZATION.emoji_trie
+    valid_run_regex = NORMALIZATION.valid_run_regex
+    cp_props = NORMALIZATION.cp_props
+    mapped = NORMALIZATION.mapped
+
+    input_len = len(input)
     input_cur = 0
-    emoji_iter = NORMALIZATION.emoji_regex.finditer(input)
-    next_emoji_match = next(emoji_iter, None)
-
-    while input_cur < len(input):
-        # if next emoji is at the current position
-        if next_emoji_match is not None and next_emoji_match.start() == input_cur:
-            # extract emoji
-            emoji = next_emoji_match.group()
-            # advance cursor
-            input_cur = next_emoji_match.end()
-            # prepare next emoji
-            next_emoji_match = next(emoji_iter, None)
+    # cps of the last token if it is a valid token that can be extended
+    valid_cps = None
+    has_emoji = False
+    # set if any valid or mapped token needs an NFC check
+    needs_nfc = False
+    # set if any input codepoint is mapped or ignored
+    has_replacements = False
+    tokens_requested = do_tokenize or do_normalizations
+
+    while input_cur < input_len:
+        c = input[input_cur]
+        cp = ord(c)
 
-            emoji_no_fe0f = filter_fe0f(emoji)
-            emoji_fe0f = NORMALIZATION.emoji_fe0f_lookup[emoji_no_fe0f]
+        # check for an emoji only if one can start with this codepoint
+        emoji_match = match_emoji(input, input_cur) if cp in emoji_trie else None
+        if emoji_match is not None:
+            emoji_end, emoji_id = emoji_match
 
             tokens.append(
                 TokenEmoji(
                     # 'pretty' version
-                    emoji=str2cps(emoji_fe0f),
+                    emoji=list(NORMALIZATION.emoji[emoji_id]),
                     # raw input
-                    input=str2cps(emoji),
+                    input=str2cps(input[input_cur:emoji_end]),
                     # text version
-                    cps=str2cps(emoji_no_fe0f),
+                    cps=list(NORMALIZATION.emoji_no_fe0f[emoji_id]),
                 )
             )
 
+            # advance cursor
+            input_cur = emoji_end
+            valid_cps = None
+            has_emoji = True
+
             continue
 
-        c = input[input_cur]
-        cp = ord(c)
         input_cur += 1
 
-        if cp == CP_STOP:
-            tokens.append(TokenStop())
-            continue
-
-        if cp in NORMALIZATION.valid:
-            tokens.append(
-                TokenValid(
-                    cps=[cp],
+        cls = cp_class[cp]
+
+        if cls == CLS_VALID:
+            run = valid_run_regex.match(input, input_cur - 1)
+            if run is not None:
+                # consume the whole run of valid codepoints
+                run_end = run.end()
+                # the run can end with the start of an emoji
+                if run_end > input_cur and ord(input[run_end - 1]) in emoji_trie:
+                    run_end -= 1
+                # inlined str2cps
+                cps = list(map(ord, input[input_cur - 1 : run_end]))
+                input_cur = run_end
+            elif cp_props[cp] & PROP_NFC_CHECK:
+                # keep codepoints that need an NFC check in their own tokens
+                needs_nfc = True
+                tokens.append(
+                    TokenValid(
+                        cps=[cp],
+                    )
                 )
-            )
+                valid_cps = None
+                continue
+            else:
+                cps = [cp]
+            # merge with the previous valid token
+            if valid_cps is None:
+                valid_cps = cps
+                tokens.append(
+                    TokenValid(
+                        cps=valid_cps,
+                    )
+                )
+            else:
+                valid_cps.extend(cps)
             continue
 
-        if cp in NORMALIZATION.ignored:
+        valid_cps = None
+
+        if cls == CLS_STOP:
+            tokens.append(TOKEN_STOP)
+        elif cls == CLS_IGNORED:
+            has_replacements = True
             tokens.append(
                 TokenIgnored(
                     cp=cp,
                 )
             )
-            continue
-
-        mapping = NORMALIZATION.mapped.get(cp)
-        if mapping is not None:
+        elif cls == CLS_MAPPED:
+            has_replacements = True
+            needs_nfc = needs_nfc or cps_requires_check(mapped[cp])
             tokens.append(
                 TokenMapped(
                     cp=cp,
-                    cps=mapping,
+                    cps=mapped[cp],
                 )
             )
-            continue
-
-        error = error or CurableSequence(
-            CurableSequenceType.INVISIBLE if c in ('\u200d', '\u200c') else CurableSequenceType.DISALLOWED,
-            index=input_cur - 1,
-            sequence=c,
-            suggested='',
-        )
+        else:
+            # only the first disallowed codepoint is reported
+            if error is None:
+                error = CurableSequence(
+                    CurableSequenceType.INVISIBLE if c in ('\u200d', '\u200c') else CurableSequenceType.DISALLOWED,
+                    index=input_cur - 1,
+                    sequence=c,
+                    suggested='',
+                )
 
-        tokens.append(
-            TokenDisallowed(
-                cp=cp,
+            tokens.append(
+                TokenDisallowed(
+                    cp=cp,
+                )
             )
-        )
-
-    tokens = normalize_tokens(tokens)
-
-    normalizations = find_normalizations(tokens) if do_normalizations else None
+            # after an error the tokens are only used if the caller asked for them
+            if not tokens_requested:
+                break
+
+    # most names have nothing to normalize
+    if needs_nfc and (error is None or tokens_requested):
+        tokens = normalize_tokens(tokens)
+
+    if not do_normalizations:
+        normalizations = None
+    elif has_replacements or has_emoji or needs_nfc:
+        normalizations = find_normalizations(tokens)
+    else:
+        # only mapped, ignored, emoji and NFC tokens are reported
+        normalizations = []
 
+    normalized = None
     if error is None:
         # run post checks
-        emojis_as_fe0f = ''.join(tokens2str(tokens, lambda _: '\ufe0f'))
+        if has_emoji:
+            emojis_as_fe0f = tokens2str(tokens, lambda _: '\ufe0f')
+        else:
+            # without emojis the normalized name can be checked directly
+            normalized = emojis_as_fe0f = tokens2str(tokens)
         # true for each label that is greek
         # will be set by post_check()
         label_is_greek = []
@@ -1067,7 +1418,10 @@ def ens_process(
         normalized = None
         beautified = None
     else:
-        normalized = tokens2str(tokens) if do_normalize else None
+        if not do_normalize:
+            normalized = None
+        elif normalized is None:
+            normalized = tokens2str(tokens)
         beautified = tokens2beautified(tokens, label_is_greek) if do_beautify else None
 
     # respect the caller's wishes even though we tokenize anyway
@@ -1101,39 +1455,45 @@ def offset_err_start(err: Optional[CurableSequence], tokens: List[Token]):
     i = 0
     # offset between input and scanned
     offset = 0
+    index = err.index
     for tok in tokens:
-        if i >= err.index:
+        if i >= index:
             # everything before the error is aligned
             break
-        if tok.type in (TY_IGNORED, TY_DISALLOWED):
+        ty = tok.type
+        # valid tokens are the most common
+        if ty == TY_VALID:
+            # input: cps, scanned: cps
+            i += len(tok.cps)
+        elif ty == TY_STOP:
+            # input: 1, scanned: 1
+            i += 1
+        elif ty == TY_IGNORED or ty == TY_DISALLOWED:
             # input: 1, scanned: 0
             offset += 1
-        elif tok.type == TY_EMOJI:
+        elif ty == TY_EMOJI:
             # input: raw emoji, scanned: FE0F
             offset += len(tok.input) - 1
             i += 1
-        elif tok.type == TY_NFC:
+        elif ty == TY_NFC:
             # input: pre NFC, scanned: post NFC
             offset += len(tok.input) - len(tok.cps)
             i += len(tok.cps)
-        elif tok.type == TY_MAPPED:
+        else:
             # input: cp, scanned: mapping
             offset += 1 - len(tok.cps)
             i += len(tok.cps)
-        elif tok.type == TY_STOP:
-            # input: 1, scanned: 1
-            i += 1
-        else:
-            # input: cps, scanned: cps
-            i += len(tok.cps)
     err.index += offset
 
 
+@lru_cache(maxsize=RESULT_CACHE_SIZE)
 def ens_normalize(text: str) -> str:
     """
     Apply ENS normalization to a string.
 
     Raises DisallowedSequence if the input cannot be normalized.
+
+    Results are cached, errors are not.
     """
     res = ens_process(text, do_normalize=True)
     if res.error is not None:
@@ -1158,21 +1518,27 @@ def _ens_cure(text: str) -> Tuple[str, List[CurableSequence]]:
     raise Exception('ens_cure() exceeded max iterations. Please report this as a bug along with the input string.')
 
 
+@lru_cache(maxsize=RESULT_CACHE_SIZE)
 def ens_cure(text: str) -> str:
     """
     Apply ENS normalization to a string. If the result is not normalized then this function
     will try to make the input normalized by removing all disallowed characters.
 
     Raises `DisallowedSequence` if one is encountered and cannot be cured.
+
+    Results are cached, errors are not.
     """
     return _ens_cure(text)[0]
 
 
+@lru_cache(maxsize=RESULT_CACHE_SIZE)
 def ens_beautify(text: str) -> str:
     """
     Apply ENS normalization with beautification to a string.
 
     Raises DisallowedSequence if the input cannot be normalized.
+
+    Results are cached, errors are not.
     """
     res = ens_process(text, do_beautify=True)
     if res.error is not None:
@@ -1225,17 +1591,30 @@ def ens_normalizations(input: str) -> List[NormalizableSequence]:
     return res.normalizations
 
 
+@lru_cache(maxsize=RESULT_CACHE_SIZE)
 def is_ens_normalized(name: str) -> bool:
     """
     Checks if the input string is already ENS normalized
     (i.e. `ens_normalize(name) == name`).
     """
+    # names with codepoints that are mapped, ignored or disallowed are not normalized
+    if NORMALIZATION.normalized_cps_regex.fullmatch(name) is None:
+        return False
     return ens_process(name, do_normalize=True).normalized == name
 
 
+@lru_cache(maxsize=RESULT_CACHE_SIZE)
 def is_ens_normalizable(name: str) -> bool:
     """
     Checks if the input string is ENS normalizable
     (i.e. `ens_normalize(name)` will not raise `DisallowedSequence`).
     """
     return ens_process(name).error is None
+
+
+def ens_cache_clear():
+    """
+    Clear the result caches of the public functions and the internal NFC cache.
+    """
+    for fn in (ens_normalize, ens_cure, ens_beautify, is_ens_normalized, is_ens_normalizable, nfc_cached):
+        fn.cache_clear()
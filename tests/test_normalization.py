@@ -10,6 +10,7 @@ from ens_normalize import (
     ens_normalizations,
     is_ens_normalized,
     is_ens_normalizable,
+    ens_cache_clear,
     DisallowedSequence,
     DisallowedSequenceType,
     CurableSequence,
@@ -20,10 +21,26 @@ import ens_normalize as ens_normalize_module
 import warnings
 import pickle
 import pickletools
+import unicodedata
+from functools import partial
+import pyunormalize
 
 
 TESTS_PATH = os.path.join(os.path.dirname(__file__), 'ens-normalize-tests.json')
 
+# C normalizers that implement the Unicode version of the spec
+C_NORMALIZERS = [
+    m
+    for m in (ens_normalize_module.normalization.unicodedata2, unicodedata)
+    if m is not None and m.unidata_version == pyunormalize.UNICODE_VERSION
+]
+
+
+@pytest.fixture(scope='session')
+def tests_data():
+    with open(TESTS_PATH, encoding='utf-8') as f:
+        return json.load(f)
+
 
 @pytest.mark.parametrize(
     'fn,field',
@@ -32,14 +49,11 @@ TESTS_PATH = os.path.join(os.path.dirname(__file__), 'ens-normalize-tests.json')
         (ens_beautify, 'beautified'),
     ],
 )
-def test_ens_normalize_full(fn, field):
-    with open(TESTS_PATH, encoding='utf-8') as f:
-        data = json.load(f)
-
+def test_ens_normalize_full(fn, field, tests_data):
     good = 0
     bad = 0
 
-    for test in data:
+    for test in tests_data:
         name = test['name']
 
         if 'error' in test:
@@ -50,8 +64,8 @@ def test_ens_normalize_full(fn, field):
             except DisallowedSequence:
                 good += 1
         else:
-            test['norm'] = test.get('norm', name)
-            expected = test[field]
+            # a missing norm means the name is already normalized
+            expected = test.get('norm', name) if field == 'norm' else test[field]
 
             try:
                 actual = fn(name)
@@ -67,31 +81,60 @@ def test_ens_normalize_full(fn, field):
     assert bad == 0, f'{100 * good / (good + bad):.2f}%, {bad} failing'
 
 
+@pytest.mark.skipif(not C_NORMALIZERS, reason='no C normalizer implements the spec Unicode version')
+def test_ens_normalize_full_c_normalizer(mocker, tests_data):
+    # the C normalizer is only selected when versions match, check it against the same vectors
+    normalize = C_NORMALIZERS[0].normalize
+    mocker.patch('ens_normalize.normalization.NFC', partial(normalize, 'NFC'))
+    mocker.patch('ens_normalize.normalization.NFD', partial(normalize, 'NFD'))
+    ens_cache_clear()
+    try:
+        good = 0
+        bad = 0
+        for test in tests_data:
+            name = test['name']
+            # only names that NFC or NFD would change
+            if pyunormalize.NFC(name) == name and pyunormalize.NFD(name) == name:
+                continue
+            try:
+                actual = (ens_normalize(name), ens_beautify(name))
+            except DisallowedSequence as e:
+                actual = None
+                if 'error' not in test:
+                    print(f'! "{name}" threw "{e}"')
+            expected = None if 'error' in test else (test.get('norm', name), test['beautified'])
+            if actual == expected:
+                good += 1
+            else:
+                bad += 1
+                print(f'! "{name}" -> {actual} != {expected}')
+        assert bad == 0, f'{100 * good / (good + bad):.2f}%, {bad} failing'
+    finally:
+        # drop results computed with the patched normalizer
+        ens_cache_clear()
+
+
 def test_ens_beautify_xi():
     assert ens_beautify('ξabc') == 'Ξabc'
     assert ens_beautify('ξλφα') == 'ξλφα'
     assert ens_beautify('ξabc.ξλφα.ξabc.ξλφα') == 'Ξabc.ξλφα.Ξabc.ξλφα'
 
 
-def test_ens_tokenize_full():
-    with open(TESTS_PATH, encoding='utf-8') as f:
-        data = json.load(f)
-
+def test_ens_tokenize_full(tests_data):
     good = 0
     bad = 0
 
-    for test in data:
+    for test in tests_data:
         if 'tokenized' not in test:
             continue
 
         name = test['name']
-        expected = test['tokenized']
-
         # we do not keep track of which tokens were changed
-        for t in expected:
-            if t['type'] == 'nfc':
-                del t['tokens']
-                del t['tokens0']
+        # copy instead of deleting, the vectors are shared between tests
+        expected = [
+            {k: v for k, v in t.items() if k not in ('tokens', 'tokens0')} if t['type'] == 'nfc' else t
+            for t in test['tokenized']
+        ]
 
         res = [t._asdict() for t in ens_tokenize(name)]
 
@@ -295,6 +338,12 @@ def test_ens_is_normalized():
     assert not is_ens_normalized('a_b')
     assert not is_ens_normalized('Abc')
     assert is_ens_normalized('')
+    # a trailing newline must not slip through the fast paths
+    for name in ('x\n', 'nick.eth\n'):
+        with pytest.raises(DisallowedSequence):
+            ens_normalize(name)
+        assert not is_ens_normalized(name)
+        assert not is_ens_normalizable(name)
 
 
 def test_normalization_error_object():
@@ -427,6 +476,21 @@ def test_ignorable_name():
     assert e.sequence == '\ufe0f\ufe0f'
 
 
+def test_result_cache():
+    ens_normalize.cache_clear()
+    assert ens_normalize('Nick.ETH') == 'nick.eth'
+    assert ens_normalize('Nick.ETH') == 'nick.eth'
+    assert ens_normalize.cache_info().hits == 1
+    # errors are raised every time
+    for _ in range(2):
+        with pytest.raises(CurableSequence) as e:
+            ens_normalize('ni_ck.eth')
+        assert e.value.index == 2
+    assert ens_normalize.cache_info().currsize == 1
+    ens_cache_clear()
+    assert ens_normalize.cache_info().currsize == 0
+
+
 def test_is_normalizable():
     assert is_ens_normalizable('nick.eth')
     assert not is_ens_normalizable('ni_ck.eth')
@@ -532,3 +596,37 @@ def test_simple_name_optimization():
     assert len(r.cures) == 0
     assert r.error is None
     assert r.normalizations is None
+
+
+def test_ascii_name_optimization():
+    r = ens_process('Nick.ETH', do_normalize=True, do_beautify=True, do_cure=True)
+    assert r.normalized == 'nick.eth'
+    assert r.beautified == 'nick.eth'
+    assert r.cured == 'nick.eth'
+    assert r.cures == []
+    assert r.error is None
+    assert r.tokens is None
+    assert r.normalizations is None
+
+    # mappings are still reported
+    r = ens_process('Nick.ETH', do_tokenize=True, do_normalizations=True)
+    assert r.tokens[0].type == 'mapped'
+    assert len(r.normalizations) == 4
+
+    assert ens_normalize('__My-Name.eth') == '__my-name.eth'
+    # errors come from the full pipeline
+    with pytest.raises(CurableSequence) as e:
+        ens_normalize('my_name.eth')
+    assert e.value.type == CurableSequenceType.UNDERSCORE
+    assert e.value.index == 2
+    with pytest.raises(CurableSequence) as e:
+        ens_normalize('ab.xn--ab')
+    assert e.value.type == CurableSequenceType.HYPHEN
+    assert e.value.index == 5
+
+    # a trailing newline is disallowed, not matched by the fast paths
+    for name in ('abc\n', 'a_b\n'):
+        r = ens_process(name, do_normalize=True)
+        assert r.normalized is None
+        assert r.error.type == CurableSequenceType.DISALLOWED
+        assert r.error.index == len(name) - 1